@@ -21,6 +21,17 @@ import tarfile
 import html
 import re
 import codecs
+import functools
+import shutil
+import bisect
+import threading
+import concurrent.futures
+
+try:
+  import zoneinfo   # available since Python 3.9
+except ImportError:
+  zoneinfo = None
+import traceback
 
 
 
@@ -74,6 +85,72 @@ class Timer(object):
 #/ class Timer(object):
 
 
+# prints the progress at most once per interval. When the console output is otherwise quiet, a single updating line is used
+class ProgressReporter(object):
+
+  def __init__(self, total_conversations, total_messages, interval=1.0, single_line=False):
+    self.total_conversations = total_conversations
+    self.total_messages = total_messages
+    self.interval = interval
+    self.single_line = single_line and sys.stdout.isatty()
+
+    self.conversations = 0
+    self.messages = 0
+    self.bytes = 0
+    self.last_line_len = 0
+
+    self.tstart = time.time()
+    self.tlast = self.tstart
+
+  def update(self, messages, bytes):
+
+    self.conversations += 1
+    self.messages += messages
+    self.bytes += bytes
+
+    now = time.time()
+    if now - self.tlast >= self.interval or self.conversations == self.total_conversations:
+      self.tlast = now
+      self.print_status(now)
+
+  def print_status(self, now):
+
+    elapsed = max(now - self.tstart, 1e-6)
+    messages_per_second = self.messages / elapsed
+
+    if self.messages > 0 and self.total_messages > self.messages:
+      eta = str(datetime.timedelta(seconds=int((self.total_messages - self.messages) / messages_per_second)))
+    elif self.conversations < self.total_conversations:
+      eta = "?"
+    else:
+      eta = "0:00:00"
+
+    text = "Progress: %s / %s conversations, %.1f conversations/s, %.0f messages/s, %.1f MB written, ETA %s" % (
+      self.conversations, 
+      self.total_conversations, 
+      self.conversations / elapsed,
+      messages_per_second,
+      self.bytes / (1024 * 1024),
+      eta
+    )
+
+    if self.single_line:
+      text = str(text).encode('utf8', 'ignore').decode('ascii', 'ignore')
+      sys.stdout.write("\r" + text.ljust(self.last_line_len))
+      sys.stdout.flush()
+      self.last_line_len = len(text)
+    else:
+      safeprint(text)
+
+  def close(self):
+
+    if self.single_line and self.last_line_len > 0:
+      sys.stdout.write("\n")
+      sys.stdout.flush()
+
+#/ class ProgressReporter(object):
+
+
 def rename_temp_file(filename, make_backup = False):  # NB! make_backup is false by default since this operation would not be atomic
 
   max_tries = 20
@@ -170,6 +247,128 @@ def read_json(jsonfilename, tarfilename=None, default_data = sentinel, quiet = F
 #/ def read_json(jsonfilename, tarfilename=None, default_data = sentinel, quiet = False):
 
 
+def get_media_object_id(filename):   # "media/0-weu-d1-abc.1.jpg" -> "0-weu-d1-abc"
+
+  result = os.path.basename(filename).split(".", 1)[0]
+  return result
+
+#/ def get_media_object_id(filename):
+
+
+def save_media_file(filename, data, semaphore):
+
+  try:
+
+    with open(filename + ".tmp", 'wb', 1024 * 1024) as fh:
+      fh.write(data)
+
+    rename_temp_file(filename)
+
+  finally:
+
+    semaphore.release()
+
+#/ def save_media_file(filename, data, semaphore):
+
+
+# Reads the messages json and extracts the media files from the tar in one sequential pass over the archive. 
+# The media files are saved by a thread pool while the archive is being read further. The number of media files held in memory at a time is bounded, and large files are copied directly without buffering them. 
+# Returns the messages data and a dict mapping media object ids to paths of the saved files, relative to the output folder
+def read_tar_with_media(jsonfilename, tarfilename, output_folder, media_subfolder = "media", max_workers = 4, max_buffered_size = 16 * 1024 * 1024, quiet = False):
+
+  data = {}
+  media_files = {}
+
+  media_folder = os.path.join(output_folder, media_subfolder)
+  if not os.path.exists(media_folder):
+    os.makedirs(media_folder)
+
+  semaphore = threading.BoundedSemaphore(max_workers * 2)
+  futures = {}
+  num_media_files = 0
+  name_counts = {}
+  reserve_len = len(" (1234)" + ".tmp" + ".old")
+
+  with Timer("file reading : " + jsonfilename + " and media files from " + tarfilename, quiet):
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+
+      with tarfile.open(name=tarfilename, mode="r|", bufsize=1024 * 1024) as tar_handle:    # r| : streaming mode, the archive is read only once
+
+        for member in tar_handle:
+
+          if not member.isfile():
+            continue
+
+          if member.name == jsonfilename:
+
+            with tar_handle.extractfile(member) as fh: 
+              raw_data = fh.read()
+              data = json.loads(raw_data.decode("utf-8", "ignore"))
+
+          elif member.name.startswith(media_subfolder + "/"):
+
+            name = sanitise_filename(os.path.basename(member.name), max_len=255-reserve_len, keep_ext=False)   # do not trust the paths inside the archive
+
+            name_count = name_counts.get(name, 0) + 1
+            name_counts[name] = name_count
+            if name_count > 1:    # handle filename collisions caused by filename sanitisation
+              root, ext = os.path.splitext(name)
+              name = root + " (" + str(name_count) + ")" + ext
+
+            is_media_file = not name.endswith(".json")   # there may be json files with metadata next to the media files
+            if is_media_file:
+              num_media_files += 1
+
+            filename = os.path.join(media_folder, name)
+
+            with tar_handle.extractfile(member) as fh: 
+
+              if member.size <= max_buffered_size:
+
+                data_bytes = fh.read()
+                semaphore.acquire()   # wait until there is room for more buffered files
+                futures[executor.submit(save_media_file, filename, data_bytes, semaphore)] = (member.name, is_media_file)
+
+              else:
+
+                with open(filename + ".tmp", 'wb', 1024 * 1024) as output_fh:
+                  shutil.copyfileobj(fh, output_fh, 1024 * 1024)
+                rename_temp_file(filename)
+
+            #/ with tar_handle.extractfile(member) as fh: 
+
+            if is_media_file:
+              media_files[get_media_object_id(member.name)] = media_subfolder + "/" + name
+
+          #/ if member.name == jsonfilename:
+
+        #/ for member in tar_handle:
+
+      #/ with tarfile.open(name=tarfilename, mode="r|", bufsize=1024 * 1024) as tar_handle:
+
+      for future in concurrent.futures.as_completed(futures):
+        member_name, is_media_file = futures[future]
+        try:
+          future.result()
+        except Exception as ex:
+          safeprint("Error saving media file " + member_name + ": " + str(ex))
+          if is_media_file:   # NB! a failed metadata file must not drop the media file that has the same object id
+            media_files.pop(get_media_object_id(member_name), None)
+            num_media_files -= 1
+
+    #/ with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+
+  #/ with Timer("file reading : " + jsonfilename + " and media files from " + tarfilename, quiet):
+
+  if not quiet:
+    safeprint("Number of media files extracted: %s" % num_media_files)
+
+  return data, media_files
+
+#/ def read_tar_with_media(jsonfilename, tarfilename, output_folder, media_subfolder = "media", max_workers = 4, max_buffered_size = 16 * 1024 * 1024, quiet = False):
+
+
 def save_txt(filename, str, quiet = False, make_backup = False):
 
   message_template = "file saving {} num of characters: {}"
@@ -190,6 +389,133 @@ def save_txt(filename, str, quiet = False, make_backup = False):
 #/ def save_txt(filename, data):
 
 
+def save_json(filename, data, quiet = False, make_backup = False):
+
+  with Timer("file saving " + filename, quiet):
+
+    with open(filename + ".tmp", 'wt', 1024 * 1024, encoding="utf-8") as fh:
+      json.dump(data, fh, indent=2)
+      fh.flush()  # just in case
+
+    rename_temp_file(filename, make_backup)
+
+  #/ with Timer("file saving " + filename, quiet):
+
+#/ def save_json(filename, data, quiet = False, make_backup = False):
+
+
+def truncate_incomplete_line(filename, chunk_size = 64 * 1024):
+
+  with open(filename, 'r+b') as fh:
+
+    size = fh.seek(0, os.SEEK_END)
+    end = size
+
+    while end > 0:   # search backwards for the last newline
+
+      start = max(0, end - chunk_size)
+      fh.seek(start)
+      newline_pos = fh.read(end - start).rfind(b"\n")
+      if newline_pos != -1:
+        end = start + newline_pos + 1
+        break
+      end = start
+
+    #/ while end > 0:
+
+    if end < size:
+      fh.truncate(end)
+
+  #/ with open(filename, 'r+b') as fh:
+
+#/ def truncate_incomplete_line(filename, chunk_size = 64 * 1024):
+
+
+# a buffered writer of JSON Lines records, used for logs that may grow large. The file is opened only when the first record arrives
+class JsonLinesLog(object):
+
+  # when appending, size can be used to cut off the records written after the given size in bytes, and count sets the number of records already in the file
+  def __init__(self, filename, append=False, size=None, count=0):
+    self.filename = filename
+    self.append = append
+    self.fh = None
+    self.count = count if append else 0
+
+    if not append and os.path.exists(filename):   # do not mix the records with those of a previous run, but keep the previous log as a backup
+      os.replace(filename, filename + ".old")   # os.replace() is able to overwrite the existing backup also on Windows
+
+    if append and os.path.exists(filename):
+
+      if size is not None:
+        if size < os.path.getsize(filename):
+          with open(filename, 'r+b') as fh:
+            fh.truncate(size)
+      else:   # a crash may have left an incomplete line at the end, which the new records must not be appended to
+        truncate_incomplete_line(filename)
+
+    #/ if append and os.path.exists(filename):
+
+  def write(self, record):
+
+    if self.fh is None:
+
+      folder = os.path.dirname(self.filename)
+      if folder and not os.path.exists(folder):
+        os.makedirs(folder)
+
+      self.fh = open(self.filename, 'at' if self.append else 'wt', 1024 * 1024, encoding="utf-8")
+
+    #/ if self.fh is None:
+
+    self.fh.write(json.dumps(record, default=str) + "\n")
+    self.count += 1
+
+  def flush(self):
+
+    if self.fh is not None:
+      self.fh.flush()
+
+  def get_size(self):   # returns the size of the file in bytes after flushing the buffered records
+
+    if self.fh is None:
+      return os.path.getsize(self.filename) if os.path.exists(self.filename) else 0
+
+    self.fh.flush()
+    return self.fh.buffer.tell()
+
+  def close(self):
+
+    if self.fh is not None:
+      self.fh.close()
+      self.fh = None
+
+#/ class JsonLinesLog(object):
+
+
+class TooManyErrors(Exception):
+  pass
+
+
+def report_error(description, message=None, conversation_id=sentinel):
+
+  if conversation_id is sentinel:
+    conversation_id = current_conversation_id
+
+  record = {
+    "conversation": conversation_id,
+    "message": message.get("id") if message else None,
+    "messagetype": message.get("messagetype") if message else None,
+    "error": description,
+    "traceback": traceback.format_exc(),
+  }
+  error_log.write(record)
+
+  if max_errors is not None and error_log.count > max_errors:
+    raise TooManyErrors("More than %s errors encountered" % max_errors)
+
+#/ def report_error(description, message=None, conversation_id=sentinel):
+
+
 last_success_iso_time_parse_format_index = 0
 iso_time_formats = [
   "%Y-%m-%dT%H:%M:%S.%fZ",
@@ -240,6 +566,53 @@ def parse_skype_username(username):
 #/ def parse_skype_username(username):
 
 
+# the same senders and group members repeat over and over again in large chats, so cache the parsed and rendered names for the duration of the run
+interned_usernames = {}
+sender_names = {}
+
+def intern_skype_username(username):
+
+  result = interned_usernames.get(username)
+  if result is None:
+    result = sys.intern(parse_skype_username(username))
+    interned_usernames[username] = result
+
+  return result
+
+#/ def intern_skype_username(username):
+
+
+def format_skype_usernames(usernames):
+
+  result = ", ".join([intern_skype_username(name) for name in usernames])
+  return result
+
+#/ def format_skype_usernames(usernames):
+
+
+def format_sender_name(from_username, displayname):
+
+  key = (from_username, displayname)
+  result = sender_names.get(key)
+  if result is None:
+
+    username = intern_skype_username(from_username)
+
+    if displayname:   # may be null
+      displayname = html.unescape(remove_tags(displayname))
+      result = displayname + " (" + username + ")"
+    else:
+      result = "(" + username + ")"
+
+    sender_names[key] = result
+
+  #/ if result is None:
+
+  return result
+
+#/ def format_sender_name(from_username, displayname):
+
+
 def parse_skype_times(message):
 
   time = parse_iso_time(message["originalarrivaltime"])
@@ -275,21 +648,109 @@ def parse_skype_times(message):
 #/ def parse_skype_times(message):
 
 
+# Converting each message time with astimezone() is slow for real time zones, so for the time range of the current conversation 
+# the UTC offset transitions (summer time changes etc) are found in advance. Then the conversion of a message time needs only a bisect 
+# in the list of transitions and an addition of a fixed offset
+timezone_range_start = None
+timezone_range_end = None
+timezone_transitions = []   # UTC times when the offset changes, the first one being the start of the range
+timezone_offsets = []       # fixed offset timezones with the name of the zone, corresponding to timezone_transitions
+
+
+def get_fixed_timezone(time):   # time is a naive UTC time
+
+  local_time = time.replace(tzinfo=datetime.timezone.utc).astimezone(output_timezone)
+  result = datetime.timezone(local_time.utcoffset(), local_time.tzname())
+  return result
+
+#/ def get_fixed_timezone(time):
+
+
+def is_same_timezone(timezone1, timezone2):
+
+  result = timezone1.utcoffset(None) == timezone2.utcoffset(None) and timezone1.tzname(None) == timezone2.tzname(None)   # NB! timezone equality operator ignores the names
+  return result
+
+#/ def is_same_timezone(timezone1, timezone2):
+
+
+def prepare_timezone_offsets(start_time, end_time, num_messages):
+  global timezone_range_start, timezone_range_end, timezone_transitions, timezone_offsets
+
+  timezone_range_start = None   # by default convert_timezone() converts each time separately
+
+  if isinstance(output_timezone, datetime.timezone):   # fixed offset timezones like UTC are cheap to convert anyway
+    return
+
+  if num_messages <= (end_time - start_time).days + 1:   # the precomputation steps over each day of the range, so for sparse conversations it would cost more than it saves
+    return
+
+  step = datetime.timedelta(days=1)   # NB! assumes that the offset does not change more than once per day
+  second = datetime.timedelta(seconds=1)
+
+  start_time = start_time.replace(microsecond=0)
+  end_time = end_time.replace(microsecond=0) + second
+
+  transitions = [start_time]
+  offsets = [get_fixed_timezone(start_time)]
+
+  prev_time = start_time
+  while prev_time < end_time:
+
+    time = min(prev_time + step, end_time)
+    offset = get_fixed_timezone(time)
+
+    if not is_same_timezone(offset, offsets[-1]):
+
+      # find the first second with the new offset
+      low = prev_time   # has the old offset
+      high = time       # has the new offset
+      while high - low > second:
+        middle = low + datetime.timedelta(seconds=int((high - low).total_seconds()) // 2)
+        if is_same_timezone(get_fixed_timezone(middle), offsets[-1]):
+          low = middle
+        else:
+          high = middle
+      #/ while high - low > second:
+
+      transitions.append(high)
+      offsets.append(get_fixed_timezone(high))
+
+    #/ if not is_same_timezone(offset, offsets[-1]):
+
+    prev_time = time
+
+  #/ while prev_time < end_time:
+
+  timezone_range_start = start_time
+  timezone_range_end = end_time
+  timezone_transitions = transitions
+  timezone_offsets = offsets
+
+#/ def prepare_timezone_offsets(start_time, end_time, num_messages):
+
+
 def convert_timezone(time):
 
-  # TODO: consider summer times
-  result = time.replace(tzinfo=datetime.timezone.utc).astimezone(output_timezone)
+  if timezone_range_start is not None and timezone_range_start <= time < timezone_range_end:
+    offset = timezone_offsets[bisect.bisect_right(timezone_transitions, time) - 1]
+    result = (time + offset.utcoffset(None)).replace(tzinfo=offset)
+  else:   # edit times and quote times may be outside of the range of the conversation
+    result = time.replace(tzinfo=datetime.timezone.utc).astimezone(output_timezone)
+
   return result
 
 #/ def convert_timezone(time):
 
 
-tag_re = re.compile(r"<.*?>", re.DOTALL)
+tag_re = re.compile(r"<[^>]*>")
 space_re = re.compile(r"[ ]+", re.DOTALL)
 
 def remove_tags(text):
 
-  text = re.sub(tag_re, " ", text)    # NB! replace tags by spaces not empty strings since they may separate words
+  # NB! the tail after the last ">" is excluded from the regex since any "<" characters there cannot start a tag, and trying each of them would make the matching quadratic
+  last_tag_end = text.rfind(">")
+  text = re.sub(tag_re, " ", text[:last_tag_end + 1]) + text[last_tag_end + 1:]    # NB! replace tags by spaces not empty strings since they may separate words
   text = re.sub(space_re, " ", text)
   result = text.strip()
 
@@ -339,20 +800,272 @@ legacyquote_tag_re = re.compile(r"<legacyquote>\[(.*?)\](.*?)</legacyquote>", re
 role_tag_re = re.compile(r"<role>(.*?)</role>", re.DOTALL)
 
 call_event_type_re = re.compile(r'<partlist .*?type="(.*?)"', re.DOTALL)
+call_id_re = re.compile(r'<partlist [^>]*?callId="([^"]*)"')
+duration_tag_re = re.compile(r"<duration>(.*?)</duration>", re.DOTALL)
 subject_re = re.compile(r'<URIObject .*?subject="(.*?)">', re.DOTALL)
 contacts_re = re.compile(r'<c .*?s="(.*?)" .*?f="(.*?)".*?(/>|></c>)', re.DOTALL)
-a_href_re = re.compile(r'<a .*?href="(.*?)".*?>', re.DOTALL)
-originalname_re = re.compile(r'<OriginalName .*?v="(.*?)".*?(/>|></OriginalName>)', re.DOTALL)
 
 
+media_tag_attributes = {
+  "a": "href",
+  "OriginalName": "v",
+  "URIObject": "uri",
+}
+max_tag_scan_len = 1024 * 1024   # the tags of interest are at the start of the content, so there is no point in scanning huge payloads to the end
+
+# Collects the values of given attributes of given tags, for example { "a": "href" } collects the links from <a href="..."> tags. 
+# Returns a dict of lists with same keys as tag_attributes. 
+# This is used instead of regexes with lazy quantifiers since these may backtrack badly on large payloads, while this scanner passes the content only once
+def scan_tag_attributes(content, tag_attributes):
+
+  result = { tag: [] for tag in tag_attributes }
+
+  scan_len = min(len(content), max_tag_scan_len)
+  tag_start = content.find("<", 0, scan_len)
+
+  while tag_start != -1:
+
+    tag_end = content.find(">", tag_start + 1, scan_len)
+    if tag_end == -1:
+      break
+
+    name_end = content.find(" ", tag_start + 1, tag_end)
+    if name_end != -1:
+
+      tag = content[tag_start + 1 : name_end]
+      attribute = tag_attributes.get(tag)
+      if attribute is not None:
+
+        attribute_start = content.find(" " + attribute + '="', name_end, tag_end)
+        if attribute_start != -1:
+          value_start = attribute_start + len(attribute) + 3
+          value_end = content.find('"', value_start, tag_end)
+          if value_end != -1:
+            result[tag].append(content[value_start : value_end])
+
+      #/ if attribute is not None:
+
+    #/ if name_end != -1:
+
+    tag_start = content.find("<", tag_end + 1, scan_len)
+
+  #/ while tag_start != -1:
+
+  return result
+
+#/ def scan_tag_attributes(content, tag_attributes):
+
+
+def parse_json_payload(content):
+
+  try:
+    return json.loads(content)
+  except Exception:   # except (TypeError, json.decoder.JSONDecodeError):
+    return None   # indexing None will raise an exception in the caller, which is then handled the same way as a missing key
+
+#/ def parse_json_payload(content):
+
+
+# Notice and PopCard messages of bot conversations repeat the same card templates thousands of times, so the rendered texts are cached by content.
+# The JSON payload is parsed only once per content, also when the first format does not match
+@functools.lru_cache(maxsize=4096)
+def format_notice_content(content):
+
+  payload = parse_json_payload(content)
+
+  try:
+
+    content2 = payload[0]["attachments"][0]["content"]
+    
+    text = content2["text"]
+    action_uri = content2["buttons"][0]["actionUri"]
+    title = content2["buttons"][0]["title"]
+
+    result = "/ Notice / " + text + " " + action_uri + " " + title
+
+  except Exception: # except (KeyError, IndexError, TypeError):
+
+    try:
+
+      content2 = payload[0]["attachments"][0]["content"]  # index again since it might be that the exception was raised already here and then we want to catch that to ensure that no stale values of content2 variable are being used
+    
+      title = content2["title"]
+      action_uri = content2["mainActionUri"]
+      text = content2["text"]
+
+      result = "/ Notice / " + title + " " + action_uri + " " + text # the changed order of title and text is on purpose here
+
+    except Exception: # except (KeyError, IndexError, TypeError):
+
+      result = "/ Notice: " + content + " /"
+
+  #/ except (KeyError, IndexError, TypeError):
+
+  return result
+
+#/ def format_notice_content(content):
+
+
+@functools.lru_cache(maxsize=4096)
+def format_popcard_content(content):
+
+  payload = parse_json_payload(content)
+
+  try:
+
+    content2 = payload[0]["content"]
+    
+    title1 = content2["title"]
+    action_uri = content2["buttons"][0]["actionUri"]
+    title2 = content2["buttons"][0]["title"]
+    media_url = content2["media"]["url"]
+
+    result = "/ PopCard / " + title1 + " " + action_uri + " " + media_url + " " + title2
+
+  except Exception: # except (KeyError, IndexError, TypeError):
+
+    attributes = scan_tag_attributes(content, media_tag_attributes)
+    links = ", ".join([html.unescape(link) for link in attributes["a"]])
+    originalnames = ", ".join([html.unescape(name) for name in attributes["OriginalName"]])
+
+    result = html.unescape(remove_tags(content))
+    result = "/ PopCard: " + originalnames + (" " + links if links not in result else "") + " / " + result
+
+  return result
+
+#/ def format_popcard_content(content):
+
+
+def format_duration(seconds):
+
+  result = str(datetime.timedelta(seconds=int(seconds)))
+  return result
+
+#/ def format_duration(seconds):
+
+
+# pairs the started and ended call events of a conversation by call id while the messages are being formatted, and computes the call durations. 
+# The call records are written to the call log only when the conversation is closed, so that a conversation that failed to be exported does not leave partial records behind
+class CallAggregator(object):
+
+  def __init__(self, conversation_id):
+    self.conversation_id = conversation_id
+    self.started = {}   # call id -> (start time, participant names)
+    self.ended = set()
+    self.records = []
+    self.num_calls = 0
+    self.num_other_events = 0
+    self.total_duration = 0
+
+  def add_event(self, event_type, call_id, time, names, durations):   # returns the duration of the call in seconds if the event ended a call and the duration is known
+
+    if event_type == "started":
+
+      if call_id is not None and call_id not in self.started:   # events without call id cannot be paired
+        self.started[call_id] = (time, names)
+      return None
+
+    elif event_type == "ended":
+
+      if call_id is not None:   # events without call id cannot be paired nor deduplicated
+
+        if call_id in self.ended:   # duplicate event
+          return None
+        self.ended.add(call_id)
+
+      start_time = self.started.pop(call_id, (None, None))[0]
+
+      if durations:   # the durations are per participant
+        duration = max(durations)
+      elif start_time:
+        duration = (time - start_time).total_seconds()
+      else:
+        duration = None
+
+      self.num_calls += 1
+      if duration is not None:
+        self.total_duration += duration
+
+      self.records.append({
+        "type": "call",
+        "conversation": self.conversation_id,
+        "call_id": call_id,
+        "started": start_time.isoformat() + "Z" if start_time else None,
+        "ended": time.isoformat() + "Z",
+        "duration": duration,
+        "participants": names,
+      })
+
+      return duration
+
+    else:   # missed calls etc
+
+      self.num_other_events += 1
+      self.records.append({
+        "type": event_type,
+        "conversation": self.conversation_id,
+        "call_id": call_id,
+        "time": time.isoformat() + "Z",
+        "participants": names,
+      })
+
+      return None
+
+    #/ if event_type == "started":
+
+  def close(self, call_log):   # returns the summary line, or None if there were no call events
+
+    for call_id, (start_time, names) in self.started.items():   # calls that did not have an ended event
+      self.records.append({
+        "type": "call",
+        "conversation": self.conversation_id,
+        "call_id": call_id,
+        "started": start_time.isoformat() + "Z",
+        "ended": None,
+        "duration": None,
+        "participants": names,
+      })
+
+    if len(self.records) == 0:
+      return None
+
+    summary = {
+      "type": "summary",
+      "conversation": self.conversation_id,
+      "calls": self.num_calls,
+      "unended_calls": len(self.started),
+      "other_call_events": self.num_other_events,
+      "total_duration": self.total_duration,
+    }
+
+    for record in self.records:
+      call_log.write(record)
+    call_log.write(summary)
+
+    result = "Calls: %s, total duration: %s, calls without end event: %s, other call events: %s" % (
+      self.num_calls, 
+      format_duration(self.total_duration), 
+      len(self.started), 
+      self.num_other_events
+    )
+    return result
+
+#/ class CallAggregator(object):
+
+
+current_conversation_id = None
+call_aggregator = None
+media_link_prefix = ""    # path from the folder of the chat file being written to the folder that the extracted media file paths are relative to
 prev_content = None
 prev_joiningenabled = True
 prev_historydisclosed = True
 
 
-def reset_conversation_state():
-  global prev_content, prev_joiningenabled, prev_historydisclosed
+def reset_conversation_state(conversation_id=None):
+  global current_conversation_id, call_aggregator, prev_content, prev_joiningenabled, prev_historydisclosed
 
+  current_conversation_id = conversation_id
+  call_aggregator = CallAggregator(conversation_id)
   prev_content = None
   prev_joiningenabled = True
   prev_historydisclosed = True
@@ -364,17 +1077,14 @@ def format_skype_message(message):
   global prev_content, prev_joiningenabled, prev_historydisclosed
 
 
+  name = ""   # in case the error happens before these fields are formatted
+  time = ""
+  edittime = None
+
   try:
 
-    username = parse_skype_username(message["from"])
-    displayname = message["displayName"]
+    name = format_sender_name(message["from"], message["displayName"])
     id = message["id"]
- 
-    if displayname:   # may be null
-      displayname = html.unescape(remove_tags(message["displayName"]))
-      name = displayname + " (" + username + ")"
-    else:
-      name = "(" + username + ")"
 
 
     time = format_time(message["time"])
@@ -429,14 +1139,18 @@ def format_skype_message(message):
       }
       message_description = mesagetype_dict[messagetype]
 
-      links = re.findall(a_href_re, content)    # TODO: the links present in Skype export file seem to be invalid, so perhaps no point in showing them in the chat log?
-      links = ", ".join([html.unescape(link) for link in links])
-
-      originalnames = re.findall(originalname_re, content)
-      originalnames = ", ".join([html.unescape(name[0]) for name in originalnames])
+      attributes = scan_tag_attributes(content, media_tag_attributes)
+      links = ", ".join([html.unescape(link) for link in attributes["a"]])    # TODO: the links present in Skype export file seem to be invalid, so perhaps no point in showing them in the chat log?
+      originalnames = ", ".join([html.unescape(name) for name in attributes["OriginalName"]])
       if originalnames != "" and messagetype == "RichText/Media_Card":
         qqq = True    # for debugging
 
+      if media_files:   # link the extracted media files
+        local_paths = [media_files.get(html.unescape(uri).rstrip("/").rsplit("/", 1)[-1]) for uri in attributes["URIObject"]]   # "https://api.asm.skype.com/v1/objects/0-weu-d1-abc" -> "0-weu-d1-abc"
+        local_paths = ", ".join([media_link_prefix + path for path in local_paths if path])
+        if local_paths:
+          originalnames += " (" + local_paths + ")"
+
       content = html.unescape(remove_tags(content))
       content = "/ " + message_description + ": " + originalnames + (" " + links if links not in content else "") + " / " + content
 
@@ -464,20 +1178,23 @@ def format_skype_message(message):
       }
       message_description = mesagetype_dict[messagetype]
 
-      links = re.findall(a_href_re, content)
-      links = ", ".join([html.unescape(link) for link in links])
+      attributes = scan_tag_attributes(content, media_tag_attributes)
+      links = ", ".join([html.unescape(link) for link in attributes["a"]])
 
       content = html.unescape(remove_tags(content)).strip()
       content = "/ " + message_description + (": " + links if links not in content else "") + " / " + content
 
     elif messagetype == "Event/Call":
 
-      # TODO: extract call duration on call type="ended" event
-
       event_type = re.findall(call_event_type_re, content)[0]
-      names = re.findall(name_tag_re, content)
-      names = ", ".join([html.unescape(remove_tags(name)) for name in names])
-      content = "/ Call " + event_type + ": " + names + " /"
+      call_ids = re.findall(call_id_re, content)
+      names_list = [html.unescape(remove_tags(name)) for name in re.findall(name_tag_re, content)]
+      durations = [int(duration) for duration in re.findall(duration_tag_re, content) if duration.strip().isdigit()]
+
+      duration = call_aggregator.add_event(event_type, call_ids[0] if call_ids else None, message["time"], names_list, durations)
+
+      names = ", ".join(names_list)
+      content = "/ Call " + event_type + ": " + names + (", duration " + format_duration(duration) if duration is not None else "") + " /"
 
     elif messagetype == "RichText/ScheduledCallInvite":
 
@@ -489,10 +1206,10 @@ def format_skype_message(message):
     elif messagetype == "ThreadActivity/AddMember":
 
       target_names_list = re.findall(target_tag_re, content)
-      target_names = ", ".join([parse_skype_username(name) for name in target_names_list])
+      target_names = format_skype_usernames(target_names_list)
 
       initiator_names_list = re.findall(initiator_tag_re, content)
-      initiator_names = ", ".join([parse_skype_username(name) for name in initiator_names_list])
+      initiator_names = format_skype_usernames(initiator_names_list)
 
       if initiator_names == target_names or not initiator_names:
         content = "/ Group member has joined: " + target_names + " /"
@@ -504,10 +1221,10 @@ def format_skype_message(message):
     elif messagetype == "ThreadActivity/DeleteMember":
 
       target_names_list = re.findall(target_tag_re, content)
-      target_names = ", ".join([parse_skype_username(name) for name in target_names_list])
+      target_names = format_skype_usernames(target_names_list)
 
       initiator_names_list = re.findall(initiator_tag_re, content)
-      initiator_names = ", ".join([parse_skype_username(name) for name in initiator_names_list])
+      initiator_names = format_skype_usernames(initiator_names_list)
 
       if initiator_names == target_names or not initiator_names:
         content = "/ Group member has left: " + target_names + " /"
@@ -522,17 +1239,17 @@ def format_skype_message(message):
       values = ", ".join([html.unescape(remove_tags(value)) for value in values_list])
 
       initiator_names_list = re.findall(initiator_tag_re, content)
-      initiator_names = ", ".join([parse_skype_username(name) for name in initiator_names_list])
+      initiator_names = format_skype_usernames(initiator_names_list)
 
       content = "/ The group topic has been set to '" + values + "' by " + initiator_names + " /"
 
     elif messagetype == "ThreadActivity/E2EEHandshakeInvite":
 
       target_names_list = re.findall(target_tag_re, content)
-      target_names = ", ".join([parse_skype_username(name) for name in target_names_list])
+      target_names = format_skype_usernames(target_names_list)
 
       initiator_names_list = re.findall(initiator_tag_re, content)
-      initiator_names = ", ".join([parse_skype_username(name) for name in initiator_names_list])
+      initiator_names = format_skype_usernames(initiator_names_list)
 
       content = "/ User " + target_names + " has been invited to encrypted conversation by " + initiator_names + " /"
 
@@ -541,10 +1258,10 @@ def format_skype_message(message):
       ):
 
       target_names_list = re.findall(target_tag_re, content)
-      target_names = ", ".join([parse_skype_username(name) for name in target_names_list])
+      target_names = format_skype_usernames(target_names_list)
 
       initiator_names_list = re.findall(initiator_tag_re, content)
-      initiator_names = ", ".join([parse_skype_username(name) for name in initiator_names_list])
+      initiator_names = format_skype_usernames(initiator_names_list)
 
       content = "/ User " + target_names + " has accepted encrypted conversation invitation by " + initiator_names + " /"
 
@@ -552,10 +1269,10 @@ def format_skype_message(message):
       ):
 
       target_names_list = re.findall(target_tag_re, content)
-      target_names = ", ".join([parse_skype_username(name) for name in target_names_list])
+      target_names = format_skype_usernames(target_names_list)
 
       initiator_names_list = re.findall(initiator_tag_re, content)
-      initiator_names = ", ".join([parse_skype_username(name) for name in initiator_names_list])
+      initiator_names = format_skype_usernames(initiator_names_list)
 
       content = "/ User " + target_names + " has rejected encrypted conversation invitation by " + initiator_names + " /"
 
@@ -572,7 +1289,7 @@ def format_skype_message(message):
     elif messagetype == "ThreadActivity/PictureUpdate":
 
       initiator_names_list = re.findall(initiator_tag_re, content)
-      initiator_names = ", ".join([parse_skype_username(name) for name in initiator_names_list])
+      initiator_names = format_skype_usernames(initiator_names_list)
 
       content = "/ User " + initiator_names + " has changed their profile picture /"  # TODO: add filename?
 
@@ -590,57 +1307,11 @@ def format_skype_message(message):
 
     elif messagetype == "Notice":  # TODO: aggregate this message with the actual user log. Currently it is under Skype concierge account log
 
-      try:
-
-        content2 = json.loads(content)[0]["attachments"][0]["content"]
-    
-        text = content2["text"]
-        action_uri = content2["buttons"][0]["actionUri"]
-        title = content2["buttons"][0]["title"]
-
-        content = "/ Notice / " + text + " " + action_uri + " " + title
-
-      except Exception: # except (KeyError, IndexError, json.decoder.JSONDecodeError):
-
-        try:
-
-          content2 = json.loads(content)[0]["attachments"][0]["content"]  # parse again since it might be that the exception was raised already here and then we want to catch that to ensure that no stale values of content2 variable are being used
-    
-          title = content2["title"]
-          action_uri = content2["mainActionUri"]
-          text = content2["text"]
-
-          content = "/ Notice / " + title + " " + action_uri + " " + text # the changed order of title and text is on purpose here
-
-        except Exception: # except (KeyError, IndexError, json.decoder.JSONDecodeError):
-
-          content = "/ Notice: " + content + " /"
-
-      #/ except (KeyError, IndexError, json.decoder.JSONDecodeError):
+      content = format_notice_content(content)
 
     elif messagetype == "PopCard":  # TODO: aggregate this message with the actual user log. Currently it is under Skype concierge account log
 
-      try:
-
-        content2 = json.loads(content)[0]["content"]
-    
-        title1 = content2["title"]
-        action_uri = content2["buttons"][0]["actionUri"]
-        title2 = content2["buttons"][0]["title"]
-        media_url = content2["media"]["url"]
-
-        content = "/ PopCard / " + title1 + " " + action_uri + " " + media_url + " " + title2
-
-      except Exception: # except (KeyError, IndexError, json.decoder.JSONDecodeError):
-
-        links = re.findall(a_href_re, content)
-        links = ", ".join([html.unescape(link) for link in links])
-
-        originalnames = re.findall(originalname_re, content)
-        originalnames = ", ".join([html.unescape(name[0]) for name in originalnames])
-
-        content = html.unescape(remove_tags(content))
-        content = "/ PopCard: " + originalnames + (" " + links if links not in content else "") + " / " + content
+      content = format_popcard_content(content)
 
     elif messagetype == "ThreadActivity/HistoryDisclosedUpdate":
 
@@ -648,7 +1319,7 @@ def format_skype_message(message):
       values = ", ".join([html.unescape(remove_tags(value)) for value in values_list])
 
       initiator_names_list = re.findall(initiator_tag_re, content)
-      initiator_names = ", ".join([parse_skype_username(name) for name in initiator_names_list])
+      initiator_names = format_skype_usernames(initiator_names_list)
 
       if values.upper() == "TRUE":
         if not prev_historydisclosed:
@@ -671,7 +1342,7 @@ def format_skype_message(message):
       values = ", ".join([html.unescape(remove_tags(value)) for value in values_list])
 
       initiator_names_list = re.findall(initiator_tag_re, content)
-      initiator_names = ", ".join([parse_skype_username(name) for name in initiator_names_list])
+      initiator_names = format_skype_usernames(initiator_names_list)
 
       if values.upper() == "TRUE":
         if not prev_joiningenabled:
@@ -691,10 +1362,10 @@ def format_skype_message(message):
     elif messagetype == "ThreadActivity/RoleUpdate":
 
       target_names_list = re.findall(id_tag_re, content)   # note, here target-id tag combination is being used, not just target
-      target_names = ", ".join([parse_skype_username(name) for name in target_names_list])
+      target_names = format_skype_usernames(target_names_list)
 
       initiator_names_list = re.findall(initiator_tag_re, content)
-      initiator_names = ", ".join([parse_skype_username(name) for name in initiator_names_list])
+      initiator_names = format_skype_usernames(initiator_names_list)
 
       roles_list = re.findall(role_tag_re, content)
       roles = ", ".join([html.unescape(remove_tags(role)) for role in roles_list])
@@ -717,8 +1388,8 @@ def format_skype_message(message):
 
   except Exception:
 
-    safeprint("Error processing a message" + str(message))
-    content = "/ Error processing a message /" + str(message)
+    report_error("Error processing a message", message)   # the details go to the error log, not to the console, since there may be thousands of such messages
+    content = "/ Error processing a message /"
 
 
   text = "%s %s%s :\n%s" % (name, time, (" - " + edittime if edittime else ""), content)
@@ -727,12 +1398,195 @@ def format_skype_message(message):
 #/ def format_skype_message(message):
 
 
-def export_chat(data, username, output_filename):
-  global prev_joiningenabled
+# writes the formatted messages of a conversation into a single file as they are being formatted, so that the whole chat text does not need to be held in memory
+class ChatWriter(object):
+
+  def __init__(self, filename):
+    self.filename = filename
+    self.folder = os.path.dirname(filename)
+    self.fh = open(filename + ".tmp", 'wt', 1024 * 1024, encoding="utf-8")    # wt format automatically handles line breaks depending on the current OS type
+    self.fh.write(BOM.decode("utf-8"))
+    self.num_rows = 0
+
+  def write(self, row, time):
+
+    if self.num_rows > 0:
+      self.fh.write("\n\n")
+    self.fh.write(row)
+    self.num_rows += 1
+
+  def close(self):    # returns the number of bytes written
+
+    self.fh.write("\n")
+    self.fh.close()
+    rename_temp_file(self.filename, make_backup=True)
+
+    return os.path.getsize(self.filename)
+
+  def abort(self):
+
+    self.fh.close()
+    os.remove(self.filename + ".tmp")
+
+#/ class ChatWriter(object):
+
+
+# writes the formatted messages of a conversation into a folder of shard files named after the month of their first message, for example "chat username/2023-04.txt". 
+# A new shard is started when the month changes (if by_month is set) or when the shard has grown over max_size characters (if max_size is set). 
+# The shards are listed in an index.json file in the same folder, together with their message counts and time ranges. 
+# The shards are kept under temporary names until the whole conversation has been written, and are then renamed together with the index, 
+# so that a conversation that fails while being formatted does not leave a mix of old and new shards behind. 
+# NB! The renaming itself is not atomic across the shards. If renaming one of the shards fails, the shards renamed before it have already replaced the old ones
+class ShardedChatWriter(object):
+
+  def __init__(self, folder, by_month=True, max_size=None):
+    self.folder = folder
+    self.by_month = by_month
+    self.max_size = max_size
+
+    if not os.path.exists(folder):
+      os.makedirs(folder)
+
+    self.shard = None
+    self.shards = []
+    self.month_counts = {}
+    self.num_bytes = 0
+
+  def write(self, row, time):
+
+    month = convert_timezone(time).strftime("%Y-%m")
+
+    if (self.shard is None 
+        or (self.by_month and month != self.shard["month"])
+        or (self.max_size and self.shard["size"] >= self.max_size)
+      ):
+      self.close_shard()
+      self.open_shard(month, time)
+
+    shard = self.shard
+    if shard["messages"] > 0:
+      shard["fh"].write("\n\n")
+    shard["fh"].write(row)
+
+    shard["messages"] += 1
+    shard["size"] += len(row) + 2
+    shard["last_time"] = time
+
+  def open_shard(self, month, time):
+
+    month_count = self.month_counts.get(month, 0) + 1
+    self.month_counts[month] = month_count
+
+    name = month + (" (" + str(month_count) + ")" if month_count > 1 else "") + ".txt"
+    filename = os.path.join(self.folder, name)
+
+    fh = open(filename + ".tmp", 'wt', 1024 * 1024, encoding="utf-8")
+    fh.write(BOM.decode("utf-8"))
+
+    self.shard = {
+      "name": name,
+      "filename": filename,
+      "fh": fh,
+      "month": month,
+      "messages": 0,
+      "size": 0,
+      "first_time": time,
+      "last_time": time,
+      "renamed": False,
+    }
+
+  def close_shard(self):
+
+    shard = self.shard
+    if shard is None:
+      return
+
+    shard["fh"].write("\n")
+    shard["fh"].close()
+
+    self.shards.append(shard)
+    self.shard = None
+
+  def close(self):    # returns the number of bytes written
+
+    self.close_shard()
+
+    index_filename = os.path.join(self.folder, "index.json")
+    prev_index = read_json(index_filename, default_data=[], quiet=True)
+
+    index = []
+    for shard in self.shards:
+
+      rename_temp_file(shard["filename"], make_backup=True)
+      shard["renamed"] = True
+
+      self.num_bytes += os.path.getsize(shard["filename"])
+      index.append({
+        "file": shard["name"],
+        "messages": shard["messages"],
+        "first_message_time": format_time(shard["first_time"]),
+        "last_message_time": format_time(shard["last_time"]),
+      })
+
+    #/ for shard in self.shards:
+
+    save_json(index_filename, index, quiet=True, make_backup=True)
+
+    # back up the shards of the previous run that were not overwritten, so that the folder contains only the shards listed in the index
+    names = set([shard["name"] for shard in self.shards])
+    for prev_shard in prev_index:
+      prev_name = os.path.basename(prev_shard["file"])
+      filename = os.path.join(self.folder, prev_name)
+      if prev_name not in names and os.path.isfile(filename):
+        os.replace(filename, filename + ".old")
+
+    return self.num_bytes
+
+  def abort(self):
+
+    if self.shard is not None:
+      self.shard["fh"].close()
+      self.shards.append(self.shard)
+      self.shard = None
+
+    for shard in self.shards:
+      if not shard["renamed"] and os.path.exists(shard["filename"] + ".tmp"):   # the shard may have been renamed already if close() failed
+        os.remove(shard["filename"] + ".tmp")
+    self.shards = []
+
+#/ class ShardedChatWriter(object):
+
+
+def create_chat_writer(output_filename):
+
+  if shard_by_month or shard_max_size:
+    folder = os.path.splitext(output_filename)[0]   # "chats/chat username.txt" -> "chats/chat username"
+    return ShardedChatWriter(folder, by_month=shard_by_month, max_size=shard_max_size)
+  else:
+    return ChatWriter(output_filename)
+
+#/ def create_chat_writer(output_filename):
+
+
+def get_media_link_prefix(chat_folder):   # the paths in media_files are relative to the "chats" folder
+
+  result = os.path.relpath("chats", chat_folder)
+  if result == ".":
+    return ""
+  else:
+    return result.replace(os.sep, "/") + "/"
+
+#/ def get_media_link_prefix(chat_folder):
+
+
+def export_chat(data, username, output_filename, quiet = False):
+  global prev_joiningenabled, media_link_prefix
 
 
-  safeprint("Working on username: " + username)
+  if not quiet:
+    safeprint("Working on username: " + username)
 
+  conversation_id = None    # NB! current_conversation_id is set only when formatting starts, so it cannot be used for errors before that
   try:
 
     output_folder = os.path.dirname(output_filename)
@@ -746,33 +1600,138 @@ def export_chat(data, username, output_filename):
       safeprint("No conversations with username '%s' found" % username)
       sys.exit()
 
+    conversation_id = selected_conversations[0]["id"]
     selected_conversation = selected_conversations[0]["MessageList"]   # assume that there is one conversation per user in Skype history
+    num_messages = len(selected_conversation)
 
 
-    with Timer("Parsing message times"):
+    with Timer("Parsing message times", quiet):
       for message in selected_conversation:
         parse_skype_times(message)
 
     with Timer("Sorting", quiet=True):
       selected_conversation.sort(key=lambda message: message["time"])    # the messages in Skype export are in reversed order
 
-    with Timer("Formatting messages"):
-      reset_conversation_state()
-      rows = [format_skype_message(message) for message in selected_conversation]
+    if num_messages > 0:
+      prepare_timezone_offsets(selected_conversation[0]["time"], selected_conversation[-1]["time"], num_messages)
 
-    text = "\n\n".join([row for row in rows if row != ""]) + "\n"    # skip empty rows that represent deleted messages
-    save_txt(output_filename, text, quiet=True, make_backup=True)
+    with Timer("Formatting and saving messages", quiet):
 
-  except KeyboardInterrupt:   # still handle Ctrl+C
+      reset_conversation_state(conversation_id)
+
+      writer = create_chat_writer(output_filename)
+      media_link_prefix = get_media_link_prefix(writer.folder)
+      try:
+
+        for message in selected_conversation:
+          row = format_skype_message(message)
+          if row != "":   # skip empty rows that represent deleted messages
+            writer.write(row, message["time"])
+
+        num_bytes = writer.close()
+
+      except BaseException:
+
+        writer.abort()
+        raise
+
+      call_summary = call_aggregator.close(call_log)   # NB! outside of the try block above since the writer cannot be aborted anymore after it has been closed
+
+    #/ with Timer("Formatting and saving messages", quiet):
+
+    if call_summary and not quiet:
+      safeprint(call_summary)
+
+    return num_messages, num_bytes
+
+  except (KeyboardInterrupt, TooManyErrors):   # still handle Ctrl+C
 
     raise
 
   except Exception:
 
     safeprint("Error in processing thread with " + username)
+    report_error("Error in processing thread with " + username, conversation_id=conversation_id)
+
+    return None
 
 
-#/ def export_chat(data, username):
+#/ def export_chat(data, username, output_filename, quiet = False):
+
+
+# collects the statistics needed for planning the conversion, without formatting the messages
+def get_archive_stats(data, username = "", num_largest_conversations = 10):
+
+  conversation_stats = []
+  messagetype_counts = {}
+  total_messages = 0
+  total_content_len = 0
+  archive_first_time = None
+  archive_last_time = None
+
+  for conv in data["conversations"]:
+
+    conv_username = parse_skype_username(conv["id"])
+    if username and conv_username != username:
+      continue
+
+    message_list = conv["MessageList"]
+    content_len = 0
+    first_time = None
+    last_time = None
+
+    for message in message_list:
+
+      messagetype = message.get("messagetype")
+      messagetype_counts[messagetype] = messagetype_counts.get(messagetype, 0) + 1
+
+      content_len += len(message.get("content") or "")
+
+      # compare the times as strings without parsing them. The fractional seconds are left out of the comparison since they are not always present
+      arrival_time = message.get("originalarrivaltime")
+      if arrival_time:
+        if first_time is None or arrival_time[:19] < first_time[:19]:
+          first_time = arrival_time
+        if last_time is None or arrival_time[:19] > last_time[:19]:
+          last_time = arrival_time
+
+    #/ for message in message_list:
+
+    conversation_stats.append({
+      "id": conv["id"],
+      "username": conv_username,
+      "displayName": conv.get("displayName"),
+      "messages": len(message_list),
+      "content_characters": content_len,
+      "first_message_time": first_time,
+      "last_message_time": last_time,
+    })
+
+    total_messages += len(message_list)
+    total_content_len += content_len
+
+    if first_time and (archive_first_time is None or first_time[:19] < archive_first_time[:19]):
+      archive_first_time = first_time
+    if last_time and (archive_last_time is None or last_time[:19] > archive_last_time[:19]):
+      archive_last_time = last_time
+
+  #/ for conv in data["conversations"]:
+
+  largest_conversations = sorted(conversation_stats, key=lambda conv: conv["messages"], reverse=True)[:num_largest_conversations]
+
+  result = {
+    "conversations": len(conversation_stats),
+    "messages": total_messages,
+    "content_characters": total_content_len,
+    "first_message_time": archive_first_time,
+    "last_message_time": archive_last_time,
+    "messagetypes": dict(sorted(messagetype_counts.items(), key=lambda item: item[1], reverse=True)),
+    "largest_conversations": [{ "id": conv["id"], "messages": conv["messages"], "content_characters": conv["content_characters"] } for conv in largest_conversations],
+    "conversation_list": conversation_stats,
+  }
+  return result
+
+#/ def get_archive_stats(data, username = "", num_largest_conversations = 10):
 
 
 # https://stackoverflow.com/questions/7406102/create-sane-safe-filename-from-any-unsafe-string
@@ -837,11 +1796,164 @@ def get_output_filename(username):
 #/ def get_output_filename(username):
 
 
+# The checkpoint is a JSON Lines file. The first line identifies the input file, each following line records one processed conversation, 
+# together with the sizes of the error and call logs and the number of errors at that point. 
+# A line is appended and flushed after every conversation, so a crash can lose at most the line being written, which is then ignored when reading. 
+# On resume, the logs are cut back to the sizes in the last line, which removes the records of the conversation that was interrupted. 
+# A conversation that failed is recorded as well, so that it is not converted again and its errors are not logged twice. 
+# The filename collision state in username_counts is not stored, but is restored by calling get_output_filename for all usernames in the same sorted order as in the original run
+def get_checkpoint_header(input_file):
+
+  result = {
+    "input_file": os.path.abspath(input_file),
+    "input_size": os.path.getsize(input_file),
+  }
+  return result
+
+#/ def get_checkpoint_header(input_file):
+
+
+# Returns a dict of completed conversations and their output filenames, and the last record, which is None if no conversation was completed. 
+# Anything after the last valid record is cut off the file, so that the resumed run can append its records after the valid ones
+def read_checkpoint(filename, header):
+
+  completed = {}
+  last_record = None
+
+  if not os.path.exists(filename):
+    return completed, last_record
+
+  valid_len = 0
+  with open(filename, 'rb', 1024 * 1024) as fh:
+
+    for index, line in enumerate(fh):
+
+      try:
+        if not line.endswith(b"\n"):   # the last line may be incomplete if the previous run crashed while writing it
+          break
+        record = json.loads(line.decode("utf-8"))
+      except ValueError:
+        break
+
+      if index == 0:
+        if record != header:
+          safeprint("The checkpoint file " + filename + " was made from a different input file, ignoring it")
+          return {}, None
+      else:
+        completed[record["conversation"]] = record["output_filename"]
+        last_record = record
+
+      valid_len += len(line)
+
+    #/ for index, line in enumerate(fh):
+
+  #/ with open(filename, 'rb', 1024 * 1024) as fh:
+
+  if valid_len < os.path.getsize(filename):
+    with open(filename, 'r+b') as fh:
+      fh.truncate(valid_len)
+
+  return completed, last_record
+
+#/ def read_checkpoint(filename, header):
+
+
+# options taking a value are marked with True
+command_line_options = {
+  "max-errors": True,
+  "quiet": False,
+  "shard": True,
+  "shard-size": True,
+  "resume": False,
+  "timezone": True,
+  "stats": False,
+  "media": False,
+  "media-jobs": True,
+}
+
+def parse_command_line(argv):
+
+  args = []
+  options = {}
+
+  index = 0
+  while index < len(argv):
+
+    arg = argv[index]
+    index += 1
+
+    if not arg.startswith("--"):
+      args.append(arg)
+      continue
+
+    name, separator, value = arg[2:].partition("=")
+    if name not in command_line_options:
+      safeprint("Unknown option: " + arg)
+      sys.exit()
+
+    if not command_line_options[name] and separator:
+      safeprint("Option --" + name + " does not take a value")
+      sys.exit()
+
+    if command_line_options[name] and not separator:
+      if index >= len(argv):
+        safeprint("Option " + arg + " requires a value")
+        sys.exit()
+      value = argv[index]
+      index += 1
+
+    options[name] = value if command_line_options[name] else True
+
+  #/ while index < len(argv):
+
+  return args, options
+
+#/ def parse_command_line(argv):
+
+
+# returns the value of a numeric option converted by number_type, or default if the option is not given. Exits if the value is not a number or is below min_value, or equal to it when min_exclusive is set
+def get_number_option(options, name, number_type, min_value, default=None, min_exclusive=False):
+
+  if name not in options:
+    return default
+
+  try:
+    result = number_type(options[name])
+  except ValueError:
+    result = None
+
+  if result is None or not (result > min_value if min_exclusive else result >= min_value) or result == float("inf"):   # NB! the comparisons are false also for nan
+    safeprint("Invalid value for --%s option: %s, expected a %s %s %s" % (name, options[name], "whole number" if number_type is int else "number", "greater than" if min_exclusive else "of at least", min_value))
+    sys.exit()
+
+  return result
+
+#/ def get_number_option(options, name, number_type, min_value, default=None, min_exclusive=False):
+
+
 # config
 
 # first argument is the python script name
-username = sys.argv[1] if len(sys.argv) >= 2 else ""
-input_file = sys.argv[2] if len(sys.argv) >= 3 else ""
+args, options = parse_command_line(sys.argv[1:])
+username = args[0] if len(args) >= 1 else ""
+input_file = args[1] if len(args) >= 2 else ""
+
+max_errors = get_number_option(options, "max-errors", int, 0)
+stats_mode = "stats" in options
+quiet = "quiet" in options or stats_mode
+extract_media = "media" in options and not stats_mode
+media_jobs = get_number_option(options, "media-jobs", int, 1, default=4)
+
+shard_by_month = False
+if "shard" in options:
+  if options["shard"] != "month":
+    safeprint("Unknown value for --shard option: " + options["shard"])
+    sys.exit()
+  shard_by_month = True
+shard_max_size = get_number_option(options, "shard-size", float, 0, min_exclusive=True)
+if shard_max_size is not None:
+  shard_max_size = max(1, int(shard_max_size * 1024 * 1024))   # NB! a size that rounds down to zero bytes would turn the sharding off
+resume = "resume" in options
 
 if input_file == "": 
 
@@ -867,6 +1979,20 @@ if input_file == "":
   safeprint('Each Skype chat or group chat log is saved into a separate file.')   # TODO: name group chat files also in human-readable form
   safeprint('If there are previously existing files with same names then these colliding old files will be backed up with names in the form "chat username.txt.old".')
   safeprint('')
+  safeprint('Options (add these after the file name):')
+  safeprint('--max-errors N : stop the conversion after more than N messages have failed to be processed.')
+  safeprint('--quiet : print only a single progress line instead of per-conversation timings.')
+  safeprint('--shard month : save each chat into a folder "chat username" with one file per month, for example "2023-04.txt", together with an "index.json" file listing the files, their message counts and time ranges.')
+  safeprint('--shard-size N : start a new file in the chat folder after approximately N megabytes of text. Can be combined with --shard month.')
+  safeprint('--resume : when extracting chat logs with all users, continue an interrupted conversion from where it stopped. The progress is tracked in "chats/checkpoint.jsonl". Conversations that failed are not converted again, and the error and call logs as well as the error count continue from where they stopped.')
+  safeprint('--timezone Area/City : show the message times in given timezone, including summer time changes, for example --timezone Europe/Tallinn. The default is UTC. Requires Python 3.9 or newer.')
+  safeprint('--stats : do not extract the chat logs, but print statistics about the archive in JSON format: message counts per chat, message types, time range, and the largest chats.')
+  safeprint('--media : extract also the media files from the export.tar into "chats/media" and mention their paths in the chat logs next to the original file names.')
+  safeprint('--media-jobs N : number of media files saved in parallel (default 4).')
+  safeprint('The details of messages that failed to be processed are saved into "chats/errors.jsonl".')
+  safeprint('The calls found in the chats, their durations and per-chat call summaries are saved into "chats/calls.jsonl".')
+  safeprint('If these files exist from a previous run then they are backed up with names in the form "errors.jsonl.old".')
+  safeprint('')
   safeprint('')
   safeprint('A Python 3 installation is required. There are no package dependencies for this software.')
   safeprint('')
@@ -896,27 +2022,82 @@ if input_file == "":
 
 
 output_time_format = r"%Y.%m.%d %H:%M:%S %Z"
-# output_timezone = datetime.timezone(datetime.timedelta(hours=2))  # NB! this will not consider summer times
-output_timezone = datetime.timezone.utc
+
+if "timezone" in options:
+
+  if zoneinfo is None:
+    safeprint("The --timezone option requires Python 3.9 or newer")
+    sys.exit()
+
+  try:
+    output_timezone = zoneinfo.ZoneInfo(options["timezone"])
+  except (zoneinfo.ZoneInfoNotFoundError, ValueError):
+    safeprint("Unknown timezone: " + options["timezone"] + ". On Windows, the timezone database can be installed with: pip install tzdata")
+    sys.exit()
+
+else:   #/ if "timezone" in options:
+
+  output_timezone = datetime.timezone.utc
+
+#/ if "timezone" in options:
 
 
 # main script
 
 os.chdir(os.path.dirname(os.path.realpath(__file__)))
 
-safeprint("Input file: " + input_file)
+if not stats_mode:    # in stats mode the output contains only the JSON
+  safeprint("Input file: " + input_file)
+
 
+media_files = {}
 
 ext = os.path.splitext(input_file)[1]
-if ext == ".tar":
-  data = read_json("messages.json", tarfilename=input_file)
+if ext == ".tar" and extract_media:
+  data, media_files = read_tar_with_media("messages.json", input_file, "chats", max_workers=media_jobs, quiet=quiet)
+elif ext == ".tar":
+  data = read_json("messages.json", tarfilename=input_file, quiet=quiet)
+elif extract_media:
+  safeprint("The --media option requires an export.tar file")
+  sys.exit()
 elif ext == ".json":
-  data = read_json(input_file)
+  data = read_json(input_file, quiet=quiet)
 else:
   safeprint("Unknown file format")
   sys.exit()
 
 
+if stats_mode:
+  stats = get_archive_stats(data, username)
+  sys.stdout.write(json.dumps(stats, indent=2) + "\n")   # NB! json.dumps escapes non-ascii characters, so the output is console safe
+  sys.exit()
+
+
+checkpoint = None
+completed = {}
+last_record = None
+if not username:    # checkpoints are used only when extracting all chats
+
+  checkpoint_filename = os.path.join("chats", "checkpoint.jsonl")
+  checkpoint_header = get_checkpoint_header(input_file)
+
+  if resume:
+    completed, last_record = read_checkpoint(checkpoint_filename, checkpoint_header)
+    safeprint("Resuming, number of conversations already completed: %s" % len(completed))
+
+  checkpoint = JsonLinesLog(checkpoint_filename, append=len(completed) > 0)
+  if len(completed) == 0:
+    checkpoint.write(checkpoint_header)
+    checkpoint.flush()
+
+#/ if not username:
+
+# NB! when resuming, drop the log records of the conversation that was interrupted, since it will be converted again
+log_state = last_record or {}
+error_log = JsonLinesLog(os.path.join("chats", "errors.jsonl"), append=last_record is not None, size=log_state.get("errors_size"), count=log_state.get("num_errors", 0))
+call_log = JsonLinesLog(os.path.join("chats", "calls.jsonl"), append=last_record is not None, size=log_state.get("calls_size"))
+
+
 if username:
   usernames = [username]
 else:   # all chats
@@ -925,10 +2106,69 @@ else:   # all chats
   usernames.sort()  # make the colliding chat log filenames deterministic. It appears that the order of usernames in input data is changing
 
 
-for index, username in enumerate(usernames):
-  output_filename = get_output_filename(username)
-  export_chat(data, username, output_filename)
-  safeprint("Progress: %s / %s" % (index + 1, len(usernames)))
+jobs = []
+for username in usernames:
+  output_filename = get_output_filename(username)   # NB! call this also for completed conversations in order to restore the filename collision state
+  if completed.get(username) == output_filename:
+    continue
+  jobs.append((username, output_filename))
+
+
+conversation_sizes = {}
+for conv in data["conversations"]:
+  conversation_sizes.setdefault(parse_skype_username(conv["id"]), len(conv["MessageList"]))  # export_chat uses the first conversation with given username
+total_messages = sum([conversation_sizes.get(username, 0) for username, output_filename in jobs])
+
+progress = ProgressReporter(len(jobs), total_messages, single_line=quiet)
+stop_reason = None
+try:
+
+  for username, output_filename in jobs:
+
+    stats = export_chat(data, username, output_filename, quiet)
+
+    if stats:
+      num_messages, num_bytes = stats
+    else:
+      num_messages, num_bytes = (0, 0)
+
+    if checkpoint:
+      record = {
+        "conversation": username,
+        "output_filename": output_filename,
+        "errors_size": error_log.get_size(),   # NB! get_size() flushes the log, so the records of a conversation are on disk before the conversation is marked as completed
+        "calls_size": call_log.get_size(),
+        "num_errors": error_log.count,
+      }
+      if not stats:
+        record["failed"] = True
+      checkpoint.write(record)
+      checkpoint.flush()
+
+    progress.update(num_messages, num_bytes)
+
+  #/ for username, output_filename in jobs:
+
+except TooManyErrors as ex:
+
+  stop_reason = str(ex)
+
+#/ try:
+
+progress.close()
+if stop_reason:
+  safeprint(stop_reason + ", stopping")
+
+if checkpoint:
+  checkpoint.close()
+  if not stop_reason:   # all done, nothing to resume
+    os.remove(checkpoint.filename)
+
+call_log.close()
+
+error_log.close()
+if error_log.count > 0:
+  safeprint("Number of errors: %s, see %s for details" % (error_log.count, error_log.filename))
 
 
 safeprint("")
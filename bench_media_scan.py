@@ -0,0 +1,81 @@
+# -*- coding: utf-8 -*-
+
+#
+# Regression benchmark for the media tag scanning in SkypeExportToText.py.
+# Runs scan_tag_attributes() and remove_tags() on adversarial payloads of growing size and fails if the running time grows clearly faster than linearly.
+#
+# Usage: python bench_media_scan.py
+#
+# Roland Pihlakas licenses this file to you under the GNU Lesser General Public License, ver 2.1.
+# See the LICENSE file for more information.
+#
+
+
+import os
+import sys
+import time
+
+
+# SkypeExportToText.py runs the conversion when executed, so load only the definitions above its config section
+script_filename = os.path.join(os.path.dirname(os.path.realpath(__file__)), "SkypeExportToText.py")
+with open(script_filename, 'rt', encoding="utf-8") as fh:
+  source = fh.read()
+source = source[:source.index("\n# config\n")]
+
+skype_export = {}
+exec(compile(source, script_filename, "exec"), skype_export)
+
+scan_tag_attributes = skype_export["scan_tag_attributes"]
+remove_tags = skype_export["remove_tags"]
+media_tag_attributes = skype_export["media_tag_attributes"]
+
+
+payloads = {
+  "unclosed <": "<",
+  "unclosed <a ": "<a ",
+  "unclosed <a href=\"": '<a href="',
+  "unclosed <OriginalName v=\"": '<OriginalName v="x',
+  "closed tags": '<a href="x">y</a><OriginalName v="z"/>',
+}
+
+base_repeats = 20000
+growth = 4
+max_time_ratio = growth * 2.5   # linear time would give a ratio close to growth, quadratic time would give growth squared
+
+
+def measure(payload, repeats, num_runs = 3):
+
+  content = payload * repeats
+
+  best = None
+  for run in range(0, num_runs):
+
+    tstart = time.perf_counter()
+    scan_tag_attributes(content, media_tag_attributes)
+    remove_tags(content)
+    elapsed = time.perf_counter() - tstart
+
+    best = elapsed if best is None else min(best, elapsed)
+
+  #/ for run in range(0, num_runs):
+
+  return best
+
+#/ def measure(payload, repeats, num_runs = 3):
+
+
+failed = False
+for name, payload in payloads.items():
+
+  small_time = measure(payload, base_repeats)
+  large_time = measure(payload, base_repeats * growth)
+  ratio = large_time / max(small_time, 1e-6)
+
+  ok = ratio <= max_time_ratio or large_time < 0.01   # very short times are dominated by noise
+  failed = failed or not ok
+
+  print("%-30s x%-6s %8.4f s   x%-6s %8.4f s   ratio %5.1f   %s" % (name, base_repeats, small_time, base_repeats * growth, large_time, ratio, "OK" if ok else "FAIL"))
+
+#/ for name, payload in payloads.items():
+
+sys.exit(1 if failed else 0)